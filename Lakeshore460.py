@@ -10,16 +10,36 @@ Reads all three probe inputs and returns individual readings as well as magnitud
 """
 
 
+import numpy as np
 import pyvisa as visa
+from pyvisa import constants, errors
 import tango
-from tango import DevState
+from tango import DevState, GreenMode
 from tango.server import Device, attribute, command
 from tango.server import device_property
 from tango import READ, READ_WRITE
-import sys
+import time
+import contextlib
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from async_timeout import timeout
 from enum import IntEnum
 
 
+# one VISA backend shared by all devices in this process
+_RM = None
+_RM_LOCK = threading.Lock()
+
+
+def _resource_manager():
+    global _RM
+    with _RM_LOCK:
+        if _RM is None:
+            _RM = visa.ResourceManager('@py')
+        return _RM
+
+
 class MeasRange(IntEnum):
     HIGHEST=0
     HIGH=1
@@ -30,12 +50,15 @@ class MeasRange(IntEnum):
 
 class Lakeshore460(Device):
 
+    green_mode = GreenMode.Asyncio
+
     mx = attribute(
         name='mx',
         access=READ,
         unit='mT',
         dtype=tango.DevFloat,
         format='%10.4f',
+        fisallowed='_is_operational',
         )
 
     my = attribute(
@@ -44,6 +67,7 @@ class Lakeshore460(Device):
         unit='mT',
         dtype=tango.DevFloat,
         format='%10.4f',
+        fisallowed='_is_operational',
         )
 
     mz = attribute(
@@ -52,30 +76,57 @@ class Lakeshore460(Device):
         unit='mT',
         dtype=tango.DevFloat,
         format='%10.4f',
+        fisallowed='_is_operational',
+        )
+
+    m = attribute(
+        name='m',
+        access=READ,
+        unit='mT',
+        dtype=tango.DevFloat,
+        format='%10.4f',
+        doc="vector magnitude, NaN while channel V is off",
+        fisallowed='_is_operational',
+        )
+
+    mxyz = attribute(
+        name='mxyz',
+        access=READ,
+        unit='mT',
+        dtype=(tango.DevFloat,),
+        max_dim_x=4,
+        format='%10.4f',
+        doc="mx, my, mz and m in a single read, m is NaN while the "
+            "magnitude channel V is off",
+        fisallowed='_is_operational',
         )
 
     xenable = attribute(
         name="xenable",
         access=READ_WRITE,
         dtype=tango.DevBoolean,
+        fisallowed='_is_operational',
         )
 
     yenable = attribute(
         name="yenable",
         access=READ_WRITE,
         dtype=tango.DevBoolean,
+        fisallowed='_is_operational',
         )
 
     zenable = attribute(
         name="zenable",
         access=READ_WRITE,
         dtype=tango.DevBoolean,
+        fisallowed='_is_operational',
         )
 
     measrange = attribute(
         label="range",
         access=READ_WRITE,
         dtype=MeasRange,
+        fisallowed='_is_operational',
         )
 
     gpib_addr = device_property(
@@ -84,107 +135,328 @@ class Lakeshore460(Device):
         update_db=True,
         )
 
-    UNIT_MULT = {'u': 1e-6, 'm': 1e-3, ' ': 1, 'k': 1e3}
+    poll_period = device_property(
+        dtype=float,
+        default_value=0.1,
+        doc="Interval in seconds between field readings",
+        )
 
-    def init_device(self):
-        Device.init_device(self)
-        self.rm = visa.ResourceManager('@py')
-        self.inst = self.rm.open_resource(f'GPIB::{self.gpib_addr}::INSTR')
-        self.inst.clear()
-        self.inst.read_termination = '\r\n'
+    # FIELDM? prefix of the range dependent field readings
+    UNIT_MULT = {'u': 1e-6, 'm': 1e-3, ' ': 1, '': 1, 'k': 1e3}
+    VISA_TIMEOUT = 500  # ms, VISA gives up on a transaction after this
+    GPIB_TIMEOUT = 1.0  # s, hard limit in case VISA does not return
+    HISTORY_LEN = 3600  # number of readings kept for get_history
+    CONFIG_TTL = 1.0  # s, age after which enables and range are re-read
+
+    async def init_device(self):
+        await super().init_device()
+        # NaN until the first successful poll
+        self._fieldvalues = np.full(4, np.nan)
+        # T -> mT including range multiplier, per channel X, Y, Z, V
+        self._scales = np.full(4, np.nan)
+        self._scales_range = None  # range the scales were read for
+        # ring buffer of (t, mx, my, mz, m), _head counts readings so far
+        self._hist = np.zeros((self.HISTORY_LEN, 5), dtype=np.float64)
+        self._head = 0
+        self._loop = asyncio.get_running_loop()
+        self._poll_handle = None
+        self._poll_task = None
+        self._cur_chnl = None
+        self._enables = None
+        self._v_on = False
+        self._range = None
+        self._config_ts = 0.0
+        self._config_gen = 0
+        # single worker keeps all GPIB transactions serialized
+        self._io_pool = ThreadPoolExecutor(max_workers=1)
+        self.inst = None
+        # failures leave the device in FAULT, Init() retries
         try:
-            ans = self.inst.query('*IDN?')
-            print(ans, file=self.log_info)
+            # backend start-up is slow, keep it off the event loop
+            self.rm = await self._gpib(_resource_manager, tmo=None)
+            self.inst = await self._gpib(
+                lambda: self.rm.open_resource(
+                    f'GPIB::{self.gpib_addr}::INSTR'),
+                tmo=None)
+            self.inst.chunk_size = 102400
+            self.inst.timeout = self.VISA_TIMEOUT
+            await self._gpib(self.inst.clear)
+            self.inst.read_termination = '\r\n'
+            ans = await self._gpib(lambda: self.inst.query('*IDN?'))
+            self.info_stream("%s", ans)
             if 'MODEL460' in ans:
-                self.configure_device()
+                await self.configure_device()
                 self.set_state(DevState.ON)
+                self._next_poll = self._loop.time()
+                self._schedule_poll()
             else:
+                self.error_stream("Not a Model 460: %s", ans)
                 self.set_state(DevState.FAULT)
-                sys.exit(255)
         except Exception as e:
-            print(e, file=self.error_stream)
-            self.inst.close()
+            self.error_stream("%s", e)
+            self.set_state(DevState.FAULT)
+
+    async def _gpib(self, op, tmo=GPIB_TIMEOUT, recover=True):
+        """Run blocking VISA call `op` in the I/O thread
+
+        VISA_TIMEOUT is shorter than `tmo`, so a regular bus timeout surfaces
+        as VisaIOError: the device goes to ALARM and, if `recover`, the
+        instrument is cleared before the error is re-raised. If `op` still
+        does not return within `tmo` seconds, the I/O thread is stuck: the
+        device goes to FAULT and asyncio.TimeoutError is raised.
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            async with timeout(tmo):
+                return await loop.run_in_executor(self._io_pool, op)
+        except asyncio.TimeoutError:
+            # no point queueing a clear behind the hanging call
+            self.error_stream("GPIB transaction hung for more than %s s", tmo)
             self.set_state(DevState.FAULT)
-            sys.exit(255)
-        self._fieldvalues = [0, 0, 0, 0]
+            self._cur_chnl = None
+            raise
+        except errors.VisaIOError as e:
+            if e.error_code == constants.StatusCode.error_timeout:
+                self.warn_stream("GPIB transaction timed out")
+                self.set_state(DevState.ALARM)
+                self._cur_chnl = None
+                if recover:
+                    # a timed out transaction can leave the buffer dirty
+                    with contextlib.suppress(errors.VisaIOError):
+                        await self._gpib(self.inst.clear, recover=False)
+            raise
+
+    def _select(self, ax):
+        """Command prefix to select channel `ax`, empty if already active"""
+        if self._cur_chnl == ax:
+            return ""
+        self._cur_chnl = ax
+        return f"CHNL {ax};"
+
+    async def _on_chnl(self, ax, cmd, query):
+        cmd = f"{self._select(ax)}{cmd}"
+        op = self.inst.query if query else self.inst.write
+        try:
+            return await self._gpib(lambda: op(cmd))
+        except Exception:
+            # instrument may not have switched, select again next time
+            self._cur_chnl = None
+            raise
+
+    async def _write_chnl(self, ax, cmd):
+        """Write `cmd` to channel `ax`, selecting it first if needed"""
+        await self._on_chnl(ax, cmd, query=False)
+
+    async def _query_chnl(self, ax, cmd):
+        """Query `cmd` on channel `ax`, selecting it first if needed"""
+        return await self._on_chnl(ax, cmd, query=True)
 
-    def always_executed_hook(self):
+    async def _is_operational(self, req_type=None):
+        """Readings and bus access are only served in ON or ALARM"""
+        return self.get_state() in (DevState.ON, DevState.ALARM)
+
+    async def always_executed_hook(self):
         pass
 
-    def measure(self, ax: str) -> float:
-        """Set active channel (X/Y/Z) and request single measurement"""
-        print(f"In measure({ax})", file=self.log_debug)
-        self.inst.write(f"CHNL {ax}")
-        mag = self.UNIT_MULT[self.inst.query("FIELDM?")]
-        val = float(self.inst.query("FIELD?"))
-        print(f"measure {ax}: {mag} * {val}", file=self.log_debug)
-        return mag * val
+    async def delete_device(self):
+        if self._poll_handle is not None:
+            self._poll_handle.cancel()
+            self._poll_handle = None
+        if self._poll_task is not None:
+            self._poll_task.cancel()
+            self._poll_task = None
+        if self.inst is not None:
+            # queued behind any transaction still running in the I/O thread;
+            # if that one hangs, give up on closing so Init() can't deadlock
+            with contextlib.suppress(asyncio.TimeoutError,
+                                     errors.VisaIOError):
+                await self._gpib(self.inst.close, recover=False)
+            self.inst = None
+        self._io_pool.shutdown(wait=False)
+
+    def _schedule_poll(self):
+        """Schedule next field reading on a fixed cadence of poll_period"""
+        self._next_poll += self.poll_period
+        now = self._loop.time()
+        if self._next_poll < now:
+            # fell behind (slow bus), don't try to catch up in a burst
+            self._next_poll = now
+        self._poll_handle = self._loop.call_at(self._next_poll,
+                                               self._start_poll)
+
+    def _start_poll(self):
+        self._poll_handle = None
+        self._poll_task = self._loop.create_task(self._do_poll())
+
+    async def _do_poll(self):
+        """Read X, Y, Z and magnitude (in mT) into the cache"""
+        try:
+            await self._refresh_config()
+            # autoranging or a front panel change can switch the multipliers
+            if (self._range in (None, MeasRange.AUTO)
+                    or self._range != self._scales_range):
+                await self._poll_multipliers()
+            ans = await self._gpib(lambda: self.inst.query('ALLF?'))
+            self.debug_stream("ALLF -> %s", ans)
+            x, y, z, m = ans.split(',', 3)
+            # parse everything first, a garbled field must not leave a
+            # half-updated vector behind
+            # ALLF? sends meaningless data for the magnitude while V is off
+            m = float(m) if self._v_on else np.nan
+            vals = (float(x), float(y), float(z), m)
+            np.multiply(vals, self._scales, out=self._fieldvalues)
+            row = self._hist[self._head % self.HISTORY_LEN]
+            row[0] = time.time()
+            row[1:] = self._fieldvalues
+            self._head += 1
+            if self.get_state() in (DevState.ALARM, DevState.FAULT):
+                self.set_state(DevState.ON)
+        except asyncio.TimeoutError:
+            pass  # already reported by _gpib
+        except errors.VisaIOError as e:
+            self.error_stream("%s", e)  # timeouts are recovered in _gpib
+        except Exception as e:
+            # e.g. garbled answer, next poll will do
+            self.error_stream("%s", e)
+        self._poll_task = None
+        self._schedule_poll()
+
+    async def read_mx(self):
+        return float(self._fieldvalues[0])
+
+    async def read_my(self):
+        return float(self._fieldvalues[1])
 
-    def read_mx(self):
-        return 1e3 * self.measure('X')
+    async def read_mz(self):
+        return float(self._fieldvalues[2])
 
-    def read_my(self):
-        return 1e3 * self.measure('Y')
+    async def read_m(self):
+        return float(self._fieldvalues[3])
 
-    def read_mz(self):
-        return 1e3 * self.measure('Z')
+    async def read_mxyz(self):
+        return self._fieldvalues
 
-    def configure_device(self):
+    async def configure_device(self):
         """Set all channels to Tesla"""
         for ax in "XYZ":
-            self.inst.write(f"CHNL {ax}")
-            self.inst.write("UNIT T")
-
-    def read_measrange(self):
-        is_auto = int(self.inst.query("AUTO?"))
-        if is_auto:
-            return MeasRange.AUTO
+            await self._write_chnl(ax, "UNIT T")
+        await self._poll_multipliers()
+
+    async def _poll_multipliers(self):
+        """Read the range dependent multiplier of X, Y, Z and V"""
+        mrange = self._range
+        scales = np.empty(4)
+        for i, ax in enumerate("XYZV"):
+            prefix = await self._query_chnl(ax, "FIELDM?")
+            scales[i] = 1e3 * self.UNIT_MULT[prefix]  # T -> mT
+        self._scales, self._scales_range = scales, mrange
+
+    async def _poll_config(self):
+        """Read enable state of all channels and range
+
+        The 460 answers only one query per message, so each query is just
+        chained to the channel selection.
+        """
+        gen = self._config_gen
+        # Z last, so AUTO? and RANGE? need no extra channel selection
+        onoff = [await self._query_chnl(ax, "ONOFF?") for ax in "VXYZ"]
+        is_auto = await self._query_chnl("Z", "AUTO?")
+        mrange = None
+        if not int(is_auto):
+            mrange = await self._query_chnl("Z", "RANGE?")
+        self.debug_stream("config: %s %s %s", onoff, is_auto, mrange)
+        if gen != self._config_gen:
+            return  # a write was queued meanwhile, answer may be outdated
+        # parse everything before touching the cache
+        # weird, manual says it's the other way
+        enables = {ax: bool(1 - int(v)) for ax, v in zip("VXYZ", onoff)}
+        v_on = enables.pop("V")
+        if int(is_auto):
+            mrange = MeasRange.AUTO
         else:
-            mrange = int(self.inst.query("RANGE?"))
-            return mrange
-
-    def write_measrange(self, value):
+            mrange = MeasRange(int(mrange))
+        self._enables, self._v_on, self._range = enables, v_on, mrange
+        self._config_ts = self._loop.time()
+
+    async def _refresh_config(self):
+        """Re-read config if unknown or older than CONFIG_TTL"""
+        while (self._enables is None
+               or self._loop.time() - self._config_ts > self.CONFIG_TTL):
+            await self._poll_config()
+
+    def _invalidate_config(self):
+        self._config_gen += 1
+        self._enables = None
+        self._range = None
+        self._config_ts = 0.0
+
+    async def read_measrange(self):
+        await self._refresh_config()
+        return self._range
+
+    async def write_measrange(self, value):
+        self._invalidate_config()
         if value == MeasRange.AUTO:
-            cmd = "AUTO 1"
+            rcmd = "AUTO 1"
         else:
-            cmd = f"RANGE {value}"
+            rcmd = f"RANGE {value}"
         for ax in "XYZ":
-            self.inst.write(f"CHNL {ax}")
-            self.inst.write(cmd)
-
-    def _read_enable(self, channel):
-        self.inst.write(f"CHNL {channel}")
-        ans = self.inst.query("ONOFF?")
-        print(f"{channel} enable: {ans}", file=self.log_debug)
-        return bool(1 - int(ans))  # weird, manual says it's the other way
-
-    def _write_enable(self, channel, value):
-        self.inst.write(f"CHNL {channel}")
-        self.inst.write(f"ONOFF {value:d}")
-
-    def read_xenable(self):
-        return self._read_enable("X")
-
-    def write_xenable(self, value):
-        self._write_enable("X", value)
-        
-    def read_yenable(self):
-        return self._read_enable("Y")
-
-    def write_yenable(self, value):
-        self._write_enable("Y", value)
-
-    def read_zenable(self):
-        return self._read_enable("Z")
-
-    def write_zenable(self, value):
-        self._write_enable("Z", value)
-
-    @command
-    def reset_device(self):
-        self.inst.clear()
-        self.inst.write('*RST')
-        self.configure_device()
+            await self._write_chnl(ax, rcmd)
+        # drop answers to queries queued between the single writes
+        self._invalidate_config()
+        await self._poll_multipliers()
+
+    async def _read_enable(self, channel):
+        await self._refresh_config()
+        return self._enables[channel]
+
+    async def _write_enable(self, channel, value):
+        self._invalidate_config()
+        await self._write_chnl(channel, f"ONOFF {value:d}")
+
+    async def read_xenable(self):
+        return await self._read_enable("X")
+
+    async def write_xenable(self, value):
+        await self._write_enable("X", value)
+
+    async def read_yenable(self):
+        return await self._read_enable("Y")
+
+    async def write_yenable(self, value):
+        await self._write_enable("Y", value)
+
+    async def read_zenable(self):
+        return await self._read_enable("Z")
+
+    async def write_zenable(self, value):
+        await self._write_enable("Z", value)
+
+    @command(
+        dtype_in=int,
+        doc_in="number of most recent readings",
+        dtype_out=(float,),
+        doc_out="rows of (t, mx, my, mz, m), oldest first, flattened",
+        )
+    async def get_history(self, n):
+        return self._last_readings(n).ravel()
+
+    def _last_readings(self, n):
+        """Latest `n` rows of the history ring buffer, oldest first"""
+        n = max(0, min(n, self._head, self.HISTORY_LEN))
+        idx = np.arange(self._head - n, self._head) % self.HISTORY_LEN
+        return self._hist[idx]
+
+    @command(fisallowed='_is_operational')
+    async def reset_device(self):
+        await self._gpib(self.inst.clear)
+        # commands queued during *RST must select their channel again
+        self._cur_chnl = None
+        await self._gpib(lambda: self.inst.write('*RST'))
+        self._cur_chnl = None
+        self._invalidate_config()
+        await self.configure_device()
+        self.set_state(DevState.ON)
 
 
 if __name__ == "__main__":
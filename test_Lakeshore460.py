@@ -0,0 +1,309 @@
+"""
+Tests for the Lakeshore460 device server logic, no GPIB hardware needed.
+
+The bus and cache logic of the device is borrowed into a plain class and
+driven against a fake instrument.
+"""
+
+import asyncio
+import math
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("pyvisa")
+pytest.importorskip("async_timeout")
+pytest.importorskip("tango")
+
+import Lakeshore460 as ls  # noqa: E402
+
+
+class FakeInst:
+    """Answers the subset of Model 460 commands used by the server"""
+
+    def __init__(self):
+        self.allf = "+1.000E+00,+2.000E+00,+3.000E+00,+4.000E+00"
+        self.onoff = {"X": "0", "Y": "0", "Z": "0", "V": "0"}
+        self.fieldm = {"X": " ", "Y": " ", "Z": " ", "V": " "}
+        self.auto = "0"
+        self.range = "1"
+        self.chnl = None
+        self.sent = []
+
+    def write(self, cmd):
+        self._run(cmd)
+
+    def query(self, cmd):
+        return self._run(cmd)
+
+    def clear(self):
+        pass
+
+    def close(self):
+        pass
+
+    def _run(self, cmd):
+        self.sent.append(cmd)
+        ans = None
+        for part in cmd.split(";"):
+            if part.startswith("CHNL "):
+                self.chnl = part[5:]
+            elif part == "ONOFF?":
+                ans = self.onoff[self.chnl]
+            elif part == "FIELDM?":
+                ans = self.fieldm[self.chnl]
+            elif part == "AUTO?":
+                ans = self.auto
+            elif part == "RANGE?":
+                ans = self.range
+            elif part == "ALLF?":
+                ans = self.allf
+        return ans
+
+
+_impl = vars(ls.Lakeshore460)
+
+
+class FakeDevice:
+    """Lakeshore460 bus, cache and history logic without a Tango server"""
+
+    UNIT_MULT = ls.Lakeshore460.UNIT_MULT
+    GPIB_TIMEOUT = ls.Lakeshore460.GPIB_TIMEOUT
+    CONFIG_TTL = ls.Lakeshore460.CONFIG_TTL
+    HISTORY_LEN = 3
+
+    _gpib = _impl['_gpib']
+    _select = _impl['_select']
+    _on_chnl = _impl['_on_chnl']
+    _write_chnl = _impl['_write_chnl']
+    _query_chnl = _impl['_query_chnl']
+    _poll_config = _impl['_poll_config']
+    _refresh_config = _impl['_refresh_config']
+    _invalidate_config = _impl['_invalidate_config']
+    _poll_multipliers = _impl['_poll_multipliers']
+    _do_poll = _impl['_do_poll']
+    _last_readings = _impl['_last_readings']
+    _write_enable = _impl['_write_enable']
+
+    def __init__(self, inst):
+        self.inst = inst
+        self.state = ls.DevState.ON
+        self.errors = []
+        self._loop = asyncio.get_running_loop()
+        self._io_pool = ThreadPoolExecutor(max_workers=1)
+        self._fieldvalues = np.full(4, np.nan)
+        self._scales = np.full(4, 1e3)
+        self._scales_range = None
+        self._hist = np.zeros((self.HISTORY_LEN, 5))
+        self._head = 0
+        self._cur_chnl = None
+        self._enables = None
+        self._v_on = False
+        self._range = None
+        self._config_ts = 0.0
+        self._config_gen = 0
+
+    def get_state(self):
+        return self.state
+
+    def set_state(self, state):
+        self.state = state
+
+    def _schedule_poll(self):
+        pass
+
+    def debug_stream(self, msg, *args):
+        pass
+
+    def warn_stream(self, msg, *args):
+        pass
+
+    def error_stream(self, msg, *args):
+        self.errors.append(msg % args)
+
+
+def run(test):
+    """Run coroutine function `test(dev, inst)` against a fresh fake"""
+    async def main():
+        inst = FakeInst()
+        dev = FakeDevice(inst)
+        try:
+            await test(dev, inst)
+        finally:
+            dev._io_pool.shutdown()
+    asyncio.run(main())
+
+
+def test_history_wraps_and_clamps():
+    async def test(dev, inst):
+        for i in range(5):
+            inst.allf = f"{i},0,0,0"
+            await dev._do_poll()
+        assert dev._head == 5
+        assert list(dev._last_readings(10)[:, 1]) == [2e3, 3e3, 4e3]
+        assert list(dev._last_readings(2)[:, 1]) == [3e3, 4e3]
+        assert dev._last_readings(0).shape == (0, 5)
+        assert dev._last_readings(-1).shape == (0, 5)
+        t = dev._last_readings(3)[:, 0]
+        assert all(np.diff(t) >= 0)
+    run(test)
+
+
+def test_history_before_wrap():
+    async def test(dev, inst):
+        await dev._do_poll()
+        assert dev._last_readings(10).shape == (1, 5)
+    run(test)
+
+
+@pytest.mark.parametrize("garbled", [
+    "1.0,2.0,x,4.0",
+    "1.0,2.0,3.0,4.0,5.0",
+    "1.0,2.0",
+    "",
+    ])
+def test_garbled_allf_keeps_previous_vector(garbled):
+    async def test(dev, inst):
+        inst.onoff["V"] = "0"
+        await dev._do_poll()
+        before = dev._fieldvalues.copy()
+        inst.allf = garbled
+        await dev._do_poll()
+        assert list(dev._fieldvalues) == list(before)
+        assert dev._head == 1
+        assert dev.errors
+    run(test)
+
+
+def test_scales_per_channel():
+    async def test(dev, inst):
+        inst.fieldm.update(X="m", Y="u", Z="k")
+        await dev._poll_multipliers()
+        await dev._do_poll()
+        assert dev._fieldvalues[:3] == pytest.approx([1.0, 2e-3, 3e6])
+        assert dev._fieldvalues[3] == pytest.approx(4e3)
+    run(test)
+
+
+def test_autorange_rereads_multipliers():
+    async def test(dev, inst):
+        inst.auto = "1"
+        await dev._do_poll()
+        inst.fieldm["X"] = "m"
+        await dev._do_poll()
+        assert dev._fieldvalues[0] == pytest.approx(1.0)
+    run(test)
+
+
+def test_magnitude_nan_while_v_off():
+    async def test(dev, inst):
+        inst.onoff["V"] = "1"  # inverted, see _poll_config
+        inst.allf = "1.0,2.0,3.0,garbage"
+        await dev._do_poll()
+        assert dev._head == 1
+        assert math.isnan(dev._fieldvalues[3])
+        assert dev._fieldvalues[0] == pytest.approx(1e3)
+    run(test)
+
+
+def test_config_uses_one_query_per_message():
+    async def test(dev, inst):
+        inst.onoff["Y"] = "1"
+        await dev._refresh_config()
+        assert dev._enables == {"X": True, "Y": False, "Z": True}
+        assert dev._range == ls.MeasRange.HIGH
+        assert all(cmd.count("?") == 1 for cmd in inst.sent)
+    run(test)
+
+
+def test_config_autorange():
+    async def test(dev, inst):
+        inst.auto = "1"
+        await dev._refresh_config()
+        assert dev._range == ls.MeasRange.AUTO
+        assert "RANGE?" not in inst.sent
+    run(test)
+
+
+def test_config_answer_dropped_after_write():
+    async def test(dev, inst):
+        task = asyncio.create_task(dev._poll_config())
+        await asyncio.sleep(0)  # first query is queued
+        dev._invalidate_config()
+        await task
+        assert dev._enables is None
+        assert dev._range is None
+    run(test)
+
+
+def test_config_ttl():
+    async def test(dev, inst):
+        await dev._refresh_config()
+        inst.onoff["X"] = "1"
+        await dev._refresh_config()
+        assert dev._enables["X"] is True  # still cached
+        dev._config_ts -= 2 * dev.CONFIG_TTL
+        await dev._refresh_config()
+        assert dev._enables["X"] is False
+    run(test)
+
+
+def test_garbled_config_leaves_cache_empty():
+    async def test(dev, inst):
+        await dev._refresh_config()
+        dev._invalidate_config()
+        inst.range = "x"
+        with pytest.raises(ValueError):
+            await dev._refresh_config()
+        assert dev._enables is None
+        assert dev._range is None
+        assert dev._config_ts == 0.0
+    run(test)
+
+
+def test_channel_selection_skipped_and_reset_on_error():
+    async def test(dev, inst):
+        await dev._write_enable("X", True)
+        await dev._write_enable("X", False)
+        assert inst.sent == ["CHNL X;ONOFF 1", "ONOFF 0"]
+
+        def fail(cmd):
+            raise OSError("bus error")
+        inst.write = fail
+        with pytest.raises(OSError):
+            await dev._write_enable("Y", True)
+        assert dev._cur_chnl is None
+    run(test)
+
+
+class FakeResourceManager:
+
+    def open_resource(self, name):
+        inst = FakeInst()
+        query = inst.query
+        inst.query = lambda cmd: (
+            "LSCI,MODEL460,0,1.0" if cmd == "*IDN?" else query(cmd))
+        return inst
+
+
+def test_device_server(monkeypatch):
+    from tango.test_context import DeviceTestContext
+    monkeypatch.setattr(ls, "_resource_manager", FakeResourceManager)
+    props = {"gpib_addr": "1", "poll_period": 0.01}
+    with DeviceTestContext(ls.Lakeshore460, properties=props,
+                           process=False) as dev:
+        assert dev.state() == ls.DevState.ON
+        for _ in range(100):
+            if not math.isnan(dev.mx):
+                break
+            time.sleep(0.01)
+        assert dev.mx == pytest.approx(1e3)
+        assert list(dev.mxyz) == pytest.approx([1e3, 2e3, 3e3, 4e3])
+        assert dev.xenable is True
+        assert dev.measrange == ls.MeasRange.HIGH
+        assert len(dev.get_history(1)) == 5
+        dev.measrange = ls.MeasRange.AUTO
+        dev.reset_device()
+        assert dev.state() == ls.DevState.ON